@@ -10,10 +10,15 @@ Zip files / archives
 ------
 ZipFiles will be automatically mounted as '<pathname>.unp' once they are cached locally. This means that
 once you try to read a zip file, it will be available as an unpacked directory locally.
+Archives are recognized by the first bytes of the file (magic numbers), not by the file name, so
+misnamed archives are unpacked and misnamed non-archives are not.
 
 The reason for not providing any 'unzip' directory before downloading the file is that this could cause
 accidental download of all zip files if a 'find' or another tool tried to traverse the unzip directories.
 
+Archives inside archives (like tarballs inside zip files) are detected by content and unpacked to
+'<pathname>.unp' when they are read, down to --max_nesting levels.
+
 NB: canvasfs now uses libarchive-c to unpack various archive formats.
 - https://github.com/Changaco/python-libarchive-c
 - ubuntu: sudo apt install python3-libarchive-c
@@ -22,7 +27,6 @@ NB: canvasfs now uses libarchive-c to unpack various archive formats.
 TODO
 ----
 - clean up class hierarchy a bit to make the zip files less kludgy.
-- safer handling of file types for detecting zip files.
 - possibility of using 'touch' or some other method for downloading an assignment without reading the files?
 - configurable cache directory.
 - rm on a file: remove from cache.  
@@ -31,7 +35,6 @@ TODO
   - files may not need to be loaded or scanned until somebody descends into the .unp directory.
   - could also use rmdir on .unp directory to remove unpacked directory. Might need a functools.cache variant with
     weakref in that case.
-- archives inside archives. (students that submit a tarball inside a zip because canvas refuses to accept tarballs)
 """
 
 import logging
@@ -39,23 +42,39 @@ from errno import ENOENT
 from stat import S_IFDIR, S_IFREG
 from time import time
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
 import functools
 import datetime
+import hashlib
 import os
 import io
 import json
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import urllib.request
+from submission_index import build_index, submission_info
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
-import zipfile
 import libarchive
 
 CACHE_DIR = ".cache"
 
+# Attribute/entry timeouts (seconds) used by the kernel cache mode unless overridden on the command line.
+# The libfuse default for both is 1 second. fusepy can't tell the kernel that an entry has changed, so
+# changes after mounting (like an empty .unp directory that is removed) can be seen until these expire.
+KERNEL_CACHE_TIMEOUT = 300.0
+
 DEBUG = False
 # LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.ERROR
 
+# Max time (seconds) a lookup inside an archive waits for the archive to be unpacked.
+UNPACK_WAIT_TIMEOUT = 120
+
+# Number of attempts shown in the latest-N view when N is not given (--views latest).
+DEFAULT_LATEST = 20
+
 # Get running user's uid/gid and reuse it for the filesystem
 fs_uid = os.getuid()
 fs_gid = os.getgid()
@@ -91,7 +110,111 @@ def merge_paths(p1, p2):
     return str(pp1 / pp2)
 
 
+def path_ino(pathname):
+    """Stable inode number for a pathname (same path gives the same inode across remounts).
+    Uses 63 bits of a blake2b hash to keep clear of signed/unsigned issues in st_ino.
+    """
+    digest = hashlib.blake2b(pathname.encode('utf-8'), digest_size=8).digest()
+    return (int.from_bytes(digest, 'little') >> 1) or 1
+
+
+class Downloader:
+    """Downloads files from Canvas into CACHE_DIR (file name = Canvas file id).
+    One instance (downloader) is shared by every course in the mount:
+    - a file is only downloaded once, even if several threads or entries ask for it at the same time.
+    - the cached files are kept within one budget (bytes, None = no limit) by removing the least recently used files.
+      Removed files are downloaded again if they are needed later.
+      Files that are in use (pinned with pin/unpin, like archives that are being unpacked) are never removed.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.fid_locks = defaultdict(threading.Lock)
+        self.lru = OrderedDict()   # fid -> size, least recently used first.
+        self.total = 0
+        self.pins = Counter()      # fid -> number of users that need the file to stay in the cache.
+
+    def scan(self):
+        """Picks up files that are already in the cache directory (oldest first)."""
+        cached = [(e.stat().st_mtime, e.name, e.stat().st_size) for e in os.scandir(CACHE_DIR)
+                  if e.is_file() and e.name.isdigit()]
+        with self.lock:
+            for _, fid, size in sorted(cached):
+                self._touch(fid, size)
+            self._evict()
+
+    def _touch(self, fid, size):
+        self.total += size - self.lru.pop(fid, 0)
+        self.lru[fid] = size
+
+    def pin(self, fid):
+        with self.lock:
+            self.pins[str(fid)] += 1
+
+    def unpin(self, fid):
+        with self.lock:
+            self.pins[str(fid)] -= 1
+            if self.pins[str(fid)] <= 0:
+                del self.pins[str(fid)]
+
+    def _evict(self):
+        # Never removes pinned files or the most recently used file (the one that is about to be read).
+        if self.budget is None or self.total <= self.budget:
+            return
+        for fid in list(self.lru)[:-1]:
+            if self.total <= self.budget:
+                break
+            if self.pins[fid] > 0:
+                continue
+            self.total -= self.lru.pop(fid)
+            logging.log(logging.DEBUG, f"Downloader: removing {fid} from the cache")
+            try:
+                os.remove(f"{CACHE_DIR}/{fid}")
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, fid, url):
+        """Returns the path to the cached file. Downloads the file first if it is not in the cache already."""
+        fid = str(fid)
+        cpath = f"{CACHE_DIR}/{fid}"
+        with self.lock:
+            fid_lock = self.fid_locks[fid]
+        with fid_lock:
+            if not os.path.exists(cpath):
+                r = urllib.request.urlopen(url)
+                if r.status != 200:
+                    logging.log(logging.DEBUG, f"TODO: check results from reading file {fid} {url} {r.status}")
+                    raise RuntimeError("Could not get file")
+                # Write to a temporary file first so other threads never see a partially written file.
+                tmp = cpath + ".part"
+                with open(tmp, 'wb') as f:
+                    f.write(r.read())
+                os.replace(tmp, cpath)
+            size = os.path.getsize(cpath)
+        with self.lock:
+            self._touch(fid, size)
+            self._evict()
+        return cpath
+
+    def open(self, fid, url):
+        """Returns the cached file opened for reading, downloading it first if necessary.
+        The file is pinned until it is open, so it can't be removed by another thread in between.
+        """
+        self.pin(fid)
+        try:
+            return open(self.fetch(fid, url), 'rb')
+        finally:
+            self.unpin(fid)
+
+
+downloader = Downloader()
+
+
 class Entry:
+    # Immutable entries never change contents once created (submission files are never modified after
+    # upload, and archive members are read from immutable files). The kernel may keep their pages cached.
+    immutable = True
+
     def __init__(self, pathname, cont, time_entry=None):
         """cont : dict with
         - timestamp in cont[time_entry],
@@ -112,6 +235,7 @@ class Entry:
         else:
             self.time = cont.get('_time', 0)
         self.size = self.cont.get('size', 0)
+        self.ino = path_ino(self.pathname)
 
     # Not all entries (like ZipEntry files) will have fid and url, so compute them at runtime
     @property
@@ -132,18 +256,7 @@ class Entry:
     def _open_file(self):
         """Opens the locally cached file. Downloads the file first if it is not in the cache already.
         Returns the opened file."""
-        cpath = self._cache_path()
-        if not self._is_cached():
-            # Need to fetch the file first
-            r = urllib.request.urlopen(self.url)
-            if r.status == 200:
-                data = r.read()
-                with open(cpath, 'wb') as f:
-                    f.write(data)
-            else:
-                logging.log(logging.DEBUG, f"TODO: check results from reading file {self.fid} {self.url} {r.status}")
-                raise RuntimeError("Could not get file")
-        return open(cpath, 'rb')
+        return downloader.open(self.fid, self.url)
 
     def read(self, size, offset):
         """Reads a chunk from a file (potentially downloading and cacheing the file if necessary)."""
@@ -151,8 +264,13 @@ class Entry:
             f.seek(offset)
             return f.read(size)
 
+    def open(self):
+        """Called when the file is opened. Entries with content that may change should refresh it here."""
+        pass
+
     def getattr(self):
         return dict(st_mode=(S_IFREG | 0o444),
+                    st_ino=self.ino,
                     st_size=self.size,
                     st_blocks=(self.size + 511) // 512,  # For du etc.
                     st_uid=fs_uid, 
@@ -168,13 +286,17 @@ class Entry:
 class DirEntry(Entry):
     def __init__(self, pathname, cont, time_entry=None):
         super().__init__(pathname, cont, time_entry=time_entry)
+        # Status change time. Bumped when the directory changes after mounting (see Context.touch_dir),
+        # mtime is kept as is so 'ls -t' still sorts by submission time.
+        self.ctime = self.time
 
     def getattr(self):
         return dict(st_mode=(S_IFDIR | 0o555),
+                    st_ino=self.ino,
                     st_nlink=2,
                     st_uid=fs_uid, 
                     st_gid=fs_gid, 
-                    st_ctime=self.time,
+                    st_ctime=self.ctime,
                     st_mtime=self.time,
                     st_atime=self.time)
 
@@ -196,17 +318,24 @@ class MetaEntry(Entry):
 
 
 class DebugEntry(Entry):
-    DEBUG_FILE = "/.debuginfo.json"
     """A debug file that provides json data about the current mounted filesystem"""
+    DEBUG_FILE = "/.debuginfo.json"
+    # Contents change as archives are unpacked.
+    immutable = False
+
     def __init__(self, pathname=None, cont=None, time_entry=None, filter_entries=None):
         d = {}
         super().__init__(self.DEBUG_FILE, d, time_entry=time_entry)
         self._update_str()
         self.time = time()
-        self.size = len(self.meta_str)
 
     def _update_str(self):
-        self.meta_str = (json.dumps({'unzipped_files' : ZipEntry.debuglst}, sort_keys=True, indent=4) + "\n").encode('utf-8')
+        self.meta_str = (json.dumps({'unzipped_files' : Unpackable.debuglst}, sort_keys=True, indent=4) + "\n").encode('utf-8')
+        self.size = len(self.meta_str)
+
+    def open(self):
+        self._update_str()
+        self.time = time()
 
     def read(self, size, offset):
         """Reads a chunk from a file (potentially downloading and cacheing the file if necessary)."""
@@ -215,6 +344,18 @@ class DebugEntry(Entry):
         return self.meta_str[start:end]
 
 
+class AliasEntry(DirEntry):
+    """A directory in a view (see View) that shares its contents with a directory in the main tree.
+    Only the name differs, lookups below the alias are resolved to the target (see Context._resolve).
+    """
+    def __init__(self, pathname, target):
+        super().__init__(pathname, {'_time': target.time})
+        self.target = target
+
+    def getattr(self):
+        return self.target.getattr()
+
+
 # ###### Zip Files / archives ######################
 # TODO: kludgy, but let's figure out how to do this before cleaning it up.
 
@@ -242,56 +383,342 @@ class ZipDirEntry(DirEntry):
         logging.log(logging.DEBUG, f"ZipDirEntry {path}")
 
 
-class ZipEntry(Entry):
-    debuglst = []
+# Magic numbers (offset, bytes, format) for archive and compression formats that libarchive can unpack.
+ARCHIVE_MAGIC = [
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),             # empty zip
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd'),
+    (0, b"7z\xbc\xaf\x27\x1c", '7z'),
+    (0, b'Rar!\x1a\x07', 'rar'),
+    (257, b'ustar', 'tar'),
+]
+# Number of bytes needed to recognize the formats above.
+SNIFF_SIZE = 512
+# Formats that compress a single file. These may be compressed tarballs or just a compressed file (notes.txt.gz).
+COMPRESSION_FORMATS = {'gzip', 'bzip2', 'xz', 'zstd'}
+# Zip based document formats. These are not unpacked.
+ZIP_DOCUMENTS = ('.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar')
+
+
+def archive_format(fpath, head):
+    """Returns the archive/compression format if head (the first SNIFF_SIZE bytes of the file) starts with the
+    magic number of a format libarchive can unpack, otherwise None.
+    """
+    if fpath.lower().endswith(ZIP_DOCUMENTS):
+        return None
+    return next((fmt for offset, magic, fmt in ARCHIVE_MAGIC if head[offset:offset + len(magic)] == magic), None)
 
-    def __init__(self, pathname, cont, ctx, time_entry=None):
-        super().__init__(pathname, cont, time_entry=time_entry)
-        self.is_unpacked = False
+
+def read_archive_entry(entry):
+    """Reads the file contents from a libarchive entry"""
+    bio = io.BytesIO()
+    for block in entry.get_blocks():
+        bio.write(block)
+    bio.seek(0)
+    return bio.read()
+
+
+# Result queue in UnpackPool worker processes (set by unpack_worker_init).
+_unpack_queue = None
+
+
+def unpack_worker_init(queue):
+    global _unpack_queue
+    _unpack_queue = queue
+
+
+def read_archive(source, format_name='all', need_filter=False):
+    """Yields (pathname, kind, time, data) for the members of the archive in source (a file path or bytes)
+    need_filter: yield nothing if the data is not compressed. With format_name='raw', libarchive passes
+    the data through unchanged if it can't be decompressed.
+    """
+    reader = libarchive.memory_reader if isinstance(source, bytes) else libarchive.file_reader
+    with reader(source, format_name=format_name) as zf:
+        for entry in zf:
+            if need_filter and not zf.filter_names:
+                return
+            t = max((t for t in (entry.ctime, entry.mtime) if t is not None), default=0)
+            data = None
+            if entry.isdir:
+                kind = 'dir'
+            elif entry.isreg:
+                kind = 'file'
+                data = read_archive_entry(entry)
+            elif entry.issym:
+                kind = 'symlink'
+            else:
+                kind = f'filetype {entry.filetype}'
+            yield entry.pathname, kind, t, data
+
+
+def unpack_worker(job, source, raw_name=None):
+    """Runs in an UnpackPool worker process. Decompresses the archive in source (a file path or the archive as bytes)
+    and sends each member to the collector as ('member', job, pathname, kind, time, data) as soon as it is extracted,
+    followed by ('done', job, error).
+    raw_name: if set, source is compressed and is unpacked as a single file with this name if it is not an archive.
+    """
+    error = None
+    sent = 0
+    try:
+        # Compressed files are mostly tarballs. With 'all', libarchive may take plain text for an mtree file.
+        for member in read_archive(source, 'tar' if raw_name is not None else 'all'):
+            _unpack_queue.put(('member', job) + member)
+            sent += 1
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    if sent == 0 and raw_name is not None:
+        try:
+            for _, kind, t, data in read_archive(source, format_name='raw', need_filter=True):
+                _unpack_queue.put(('member', job, raw_name, kind, t, data))
+                error = None
+        except Exception:
+            pass
+    _unpack_queue.put(('done', job, error))
+
+
+class UnpackPool:
+    """Unpacks archives in worker processes, so decompression does not hold the GIL and block FUSE threads.
+    The workers stream members back on a queue, and a collector thread adds them to the archive's ZipEntry
+    (and the filesystem) as they arrive. Lookups only wait for the member they need (see Context._wait_unpack).
+    If a worker dies (like a crash in libarchive on a malformed archive), the pool breaks. Its outstanding
+    jobs are then failed, and a new pool is started for the next archive.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.pool = None
+        self.broken = False
+        self.lock = threading.Lock()
+        self.jobs = {}   # job id -> ZipEntry
+        self.next_job = 0
+
+    def _start(self):
+        """Starts a new pool (and result queue + collector). Called with self.lock held."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        # spawn: forking a process with running FUSE threads is not safe.
+        mp_ctx = multiprocessing.get_context('spawn')
+        # SimpleQueue writes to the pipe in put() (no feeder thread), so all messages are sent when a job returns.
+        # A new queue as well: a worker that died while writing to the old one may have left it corrupted.
+        queue = mp_ctx.SimpleQueue()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=mp_ctx,
+                                                           initializer=unpack_worker_init, initargs=(queue,))
+        self.broken = False
+        threading.Thread(target=self._collect, args=(queue,), name="unpack-collector", daemon=True).start()
+
+    def submit(self, zentry, source, raw_name=None):
+        with self.lock:
+            job = self.next_job
+            self.next_job += 1
+            self.jobs[job] = zentry
+        # Try again once with a new pool if the current pool turns out to be broken.
+        for _ in range(2):
+            pool = None
+            try:
+                with self.lock:
+                    if self.pool is None or self.broken:
+                        self._start()
+                    pool = self.pool
+                fut = pool.submit(unpack_worker, job, source, raw_name)
+            except (BrokenProcessPool, RuntimeError) as e:
+                # RuntimeError: the pool was shut down by another thread starting a new one.
+                error = f"{type(e).__name__}: {e}"
+                with self.lock:
+                    if self.pool is pool:
+                        self.broken = True
+                continue
+            except Exception as e:
+                # Anything else (like a pool that can't be started) fails the job, so the .unp directory is removed.
+                error = f"{type(e).__name__}: {e}"
+                break
+            fut.add_done_callback(functools.partial(self._check_failed, job, pool))
+            return
+        self._finish(job, error)
+
+    def _check_failed(self, job, pool, fut):
+        # The worker reports its own errors. This catches workers that died or could not start.
+        if fut.cancelled():
+            error = "cancelled"
+        elif (e := fut.exception()) is not None:
+            error = f"{type(e).__name__}: {e}"
+            if isinstance(e, BrokenProcessPool):
+                with self.lock:
+                    if self.pool is pool:
+                        self.broken = True
+        else:
+            return
+        self._finish(job, error)
+
+    def _finish(self, job, error):
+        with self.lock:
+            zentry = self.jobs.pop(job, None)
+        if zentry is not None:
+            zentry.finish_unpack(error)
+
+    def _collect(self, queue):
+        while True:
+            msg = queue.get()
+            if msg[0] == 'member':
+                if (zentry := self.jobs.get(msg[1], None)) is not None:
+                    zentry.add_member(*msg[2:])
+            else:
+                self._finish(msg[1], msg[2])
+
+
+unpack_pool = UnpackPool()
+
+
+class Unpackable:
+    """Unpacks an archive into a '<pathname>.unp' directory.
+    Used by ZipEntry (archives submitted to Canvas) and ZipArchiveEntry (archives inside archives).
+    The archive is unpacked by unpack_pool, and members are added as they are extracted.
+    Subclasses provide:
+    - _archive_format(): the archive format (see archive_format), None if it is not an archive.
+    - _unpack_source(): path to the archive file or a bytes object with the archive.
+    - _can_unpack() may be extended to check that the archive is available (it is called with start_lock held).
+    """
+    debuglst = []
+    # Most entries are never unpacked (most files aren't archives), so the unpack state (unpack_cond etc)
+    # is only created when unpacking starts. Until then, these class attributes are used.
+    is_unpacked = False     # Set when unpacking starts
+    not_archive = False     # Set when the file turns out not to be an archive. check_unpack then returns right away.
+    # Serializes the decision to start unpacking (the entries have no lock of their own before that).
+    start_lock = threading.Lock()
+
+    def _init_unpack(self, ctx, depth):
         self.ctx = ctx
-        self.check_unpack()
+        self.depth = depth          # nesting level: 0 for submitted archives, +1 for each archive inside an archive.
 
-    def read_entry(self, entry):
-        """Reads the file contents from the entry"""
-        bio = io.BytesIO()
-        for block in entry.get_blocks():
-            bio.write(block)
-        bio.seek(0)
-        return bio.read()
+    @property
+    def dir_prefix(self):
+        """The pathname of the unpack directory"""
+        return self.pathname + ".unp"
+
+    def _can_unpack(self):
+        if not auto_unpack:
+            return False
+        if self._archive_format() is None:
+            self.not_archive = True
+            return False
+        return True
 
     def check_unpack(self):
-        if self.is_unpacked or (not auto_unpack) or (not self._is_cached()):
-            # not ready for auto_unpack, already unpacked, or can't unpack if not cached
+        if self.is_unpacked or self.not_archive:
             return
-        try:
-            cpath = self._cache_path()
-            with libarchive.file_reader(cpath) as zf:
-                # Some zipfiles don't include subdirectory entries (only direct paths to files).
-                # This will be handled in add_entry.
-                dir_prefix = self.pathname + ".unp"  # the pathname of the unpack directory
-                print("Unpacking ", dir_prefix)
-                # add the root/mount point
-                self.ctx.add_entry(ZipDirEntry(dir_prefix, {'_time': self.time}))
-                # add each of the directories and files listed in the zip file.
-                for entry in zf:
-                    path = merge_paths(dir_prefix, entry.pathname)    # f"{dir_prefix}/{entry.pathname}"
-                    info = {"_time": max(t for t in (entry.ctime, entry.mtime) if t is not None)}
-                    if entry.isdir:
-                        self.ctx.add_entry(ZipDirEntry(path, info))
-                    elif entry.isreg:
-                        # Regular file
-                        self.debuglst.append(path)
-                        self.ctx.add_entry(ZipFileEntry(path, info, self.read_entry(entry)))
-                    else:
-                        if entry.issym:
-                            print(f"NB (ZipEntry): skipping symbolic link: {path}")
-                        else:
-                            print(f"WARNING: ZipEntry: {path} is of unhandled file type {entry.filetype} {entry.issym=}")
+        with self.start_lock:
+            if self.is_unpacked or self.not_archive or not self._can_unpack():
+                # not ready for auto_unpack, already unpacked, or can't unpack if not cached
+                return
+            self.unpack_done = False    # Set when all members are added (or unpacking failed)
+            self.unpack_cond = threading.Condition()
+            self.n_members = 0
             self.is_unpacked = True
-        except zipfile.BadZipFile:
-            # TODO: this exception is from zipFile and will probably never be thrown by libarchive.
-            print(f"Failed to open {self.pathname} ({cpath}) - bad zipfile")
-                
+        print("Unpacking ", self.dir_prefix)
+        # add the root/mount point. The members are added by add_member as they are extracted by unpack_pool.
+        # Some zipfiles don't include subdirectory entries (only direct paths to files).
+        # This will be handled in add_entry.
+        self.ctx.unpacking[self.dir_prefix] = self
+        self.ctx.add_entry(ZipDirEntry(self.dir_prefix, {'_time': self.time}))
+        # A compressed file that is not a tarball is unpacked as the file without the compression extension.
+        raw_name = Path(self.fname).stem if self._archive_format() in COMPRESSION_FORMATS else None
+        unpack_pool.submit(self, self._unpack_source(), raw_name)
+
+    def add_member(self, pathname, kind, t, data):
+        """Adds a directory or file extracted from the archive (called from the unpack_pool collector)."""
+        path = merge_paths(self.dir_prefix, pathname)    # f"{dir_prefix}/{entry.pathname}"
+        info = {"_time": t}
+        with self.unpack_cond:
+            if kind == 'dir':
+                self.ctx.add_entry(ZipDirEntry(path, info))
+            elif kind == 'file':
+                # Regular file
+                self.debuglst.append(path)
+                if self.depth < max_nesting and archive_format(path, data[:SNIFF_SIZE]) is not None:
+                    self.ctx.add_entry(ZipArchiveEntry(path, info, data, self.ctx, self.depth + 1))
+                else:
+                    self.ctx.add_entry(ZipFileEntry(path, info, data))
+            elif kind == 'symlink':
+                print(f"NB (ZipEntry): skipping symbolic link: {path}")
+            else:
+                print(f"WARNING: ZipEntry: {path} is of unhandled file type {kind}")
+            self.n_members += 1
+            self.unpack_cond.notify_all()
+
+    def finish_unpack(self, error):
+        if error is not None:
+            print(f"Failed to unpack {self.pathname} - {error}")
+        with self.unpack_cond:
+            if self.n_members == 0:
+                # Not an archive (or an empty one). Don't leave an empty .unp directory behind.
+                self.ctx.remove_entry(self.dir_prefix)
+            self.unpack_done = True
+            self.ctx.unpacking.pop(self.dir_prefix, None)
+            self.unpack_cond.notify_all()
+
+    def wait_for(self, path=None):
+        """Waits until path has been extracted or the archive is completely unpacked (path=None: wait for all).
+        Gives up after UNPACK_WAIT_TIMEOUT seconds.
+        """
+        with self.unpack_cond:
+            self.unpack_cond.wait_for(lambda: self.unpack_done or (path is not None and path in self.ctx.files),
+                                      timeout=UNPACK_WAIT_TIMEOUT)
+
+
+class ZipArchiveEntry(Unpackable, ZipFileEntry):
+    """An archive inside an archive (like a tarball inside a zip file, as Canvas refuses tarballs).
+    Unpacked straight from the in-memory data when it is read, like ZipEntry.
+    """
+    def __init__(self, path, info, data, ctx, depth):
+        super().__init__(path, info, data)
+        self._init_unpack(ctx, depth)
+
+    def _archive_format(self):
+        return archive_format(self.pathname, self._data[:SNIFF_SIZE])
+
+    def _unpack_source(self):
+        return self._data
+
+    def read(self, size, offset):
+        data = super().read(size, offset)
+        self.check_unpack()
+        return data
+
+
+class ZipEntry(Unpackable, Entry):
+    """A submitted file that may be an archive. It is unpacked once it is cached, if the first bytes of the file
+    show that it is an archive.
+    """
+    # Archive format (or None) for each probed file id. Files on Canvas never change, so this is only checked once.
+    archive_types = {}
+
+    def __init__(self, pathname, cont, ctx, time_entry=None):
+        super().__init__(pathname, cont, time_entry=time_entry)
+        self._init_unpack(ctx, 0)
+        self.check_unpack()
+
+    def _can_unpack(self):
+        if not auto_unpack:
+            return False
+        # The cached file must stay until the unpack worker has read it (unpinned in finish_unpack).
+        # Files that are not cached yet are checked again when they are read.
+        downloader.pin(self.fid)
+        if self._is_cached() and super()._can_unpack():
+            return True
+        downloader.unpin(self.fid)
+        return False
+
+    def _archive_format(self):
+        return self.probe(self.fid, self.fname)
+
+    def _unpack_source(self):
+        return self._cache_path()
+
+    def finish_unpack(self, error):
+        super().finish_unpack(error)
+        downloader.unpin(self.fid)
+
     def read(self, size, offset):
         # TODO: some larger files are very slow to read using this. Consider using an lru_cache for the file contents?
         # Could be a side effect of buffer size in 'wc'...
@@ -303,12 +730,22 @@ class ZipEntry(Entry):
         return data
 
     @classmethod
-    def possible_archive(self, fpath):
-        lfpath = fpath.lower()
-        # TODO: a safer option could be to try to open the file with libarchive.
-        # libarchive does not appear to provide a function that checks if it may be an archive (like magic keys)
-        return any(lfpath.endswith(end) for end in
-                   ['.zip', '.rar', '.tar.gz', '.tgz', '.tar', '.7z'])
+    def probe(cls, fid, fpath):
+        """Returns the archive format of the cached file fid, reading only the first few bytes of the file."""
+        if fid not in cls.archive_types:
+            with open(f"{CACHE_DIR}/{fid}", 'rb') as f:
+                cls.archive_types[fid] = archive_format(fpath, f.read(SNIFF_SIZE))
+        return cls.archive_types[fid]
+
+    @classmethod
+    def possible_archive(cls, fid, fpath):
+        """Files that are not cached yet could be archives (checked when they are downloaded).
+        Cached files are checked right away.
+        """
+        try:
+            return cls.probe(fid, fpath) is not None
+        except FileNotFoundError:
+            return True
 
 
 # Some of this class is based on the Context example from the fusepy distribution.
@@ -319,35 +756,85 @@ class Context(LoggingMixIn, Operations):
     flush = None
     getxattr = None
     listxattr = None
-    open = None
     opendir = None
     release = None
     releasedir = None
     statfs = None
 
-    def __init__(self):
+    def __init__(self, kernel_cache=False):
         # dirs is used to keep track of files and subdirectories in each directory.
         # files are each file/directory in the filesystem with an Entry object for each file (key = path).
+        # kernel_cache: FUSE is started with raw_fi=True, and open() tells the kernel which files it may keep cached.
         super().__init__()
         self.dirs = defaultdict(list)
         self.files = {}
+        self.kernel_cache = kernel_cache
+        # views: root path -> View.  aliases: path in a view -> path in the main tree.
+        self.views = {}
+        self.aliases = {}
+        # .unp directory -> ZipEntry for archives that are being unpacked.
+        self.unpacking = {}
+
+    def _resolve(self, path, listing=False):
+        """Maps a path inside a view to the path in the main tree that holds the shared entries.
+        The view is populated the first time something inside it is looked up (or the view root is listed).
+        Paths outside views are returned as is.
+        """
+        parts = path.split('/')
+        # View roots are either /<view> or /<course>/<view>
+        if (view := self.views.get('/'.join(parts[:2]), None) or self.views.get('/'.join(parts[:3]), None)) is None:
+            return path
+        root_len = len(view.root.split('/'))
+        if len(parts) > root_len or listing:
+            view.materialize(self)
+        for i in range(len(parts), root_len, -1):
+            if (target := self.aliases.get('/'.join(parts[:i]), None)) is not None:
+                return '/'.join([target] + parts[i:])
+        return path
+
+    def _wait_unpack(self, path, listing=False):
+        """If path is inside an archive that is being unpacked, waits until the path has been extracted.
+        Listing a directory waits for the complete archive.
+        """
+        for prefix, zentry in list(self.unpacking.items()):
+            if path == prefix or path.startswith(prefix + '/'):
+                zentry.wait_for(None if listing else path)
 
     def getattr(self, path, fh=None):
         # uid, gid, pid = fuse_get_context()
-        if (entry := self.files.get(path, None)):
+        rpath = self._resolve(path)
+        if (entry := self.files.get(rpath, None)):
             return entry.getattr()
+        if self.unpacking:
+            self._wait_unpack(rpath)
+            if (entry := self.files.get(rpath, None)):
+                return entry.getattr()
         raise FuseOSError(ENOENT)
 
+    def open(self, path, fi):
+        # fi is the raw fuse_file_info when kernel_cache is set, otherwise the open flags.
+        if (entry := self.files.get(self._resolve(path), None)) is None:
+            raise FuseOSError(ENOENT)
+        entry.open()
+        if self.kernel_cache:
+            # Immutable files can keep their pages in the kernel page cache between opens.
+            # Files with changing contents bypass the page cache so stale data is never served.
+            fi.keep_cache = int(entry.immutable)
+            fi.direct_io = int(not entry.immutable)
+        return 0
+
     def read(self, path, size, offset, fh):
         # logging.log(logging.DEBUG, f"**read**({path}, {size}, {offset}, {fh})")
-        if path in self.files:
-            e = self.files[path]
+        if (e := self.files.get(self._resolve(path), None)) is not None:
             return e.read(size, offset)
         raise RuntimeError('unexpected path: %r' % path)
 
     def readdir(self, path, fh):
         # logging.log(logging.DEBUG, f"readdir: {path} {[d.fname for d in dirs.get(path, [])]}")
-        return [d.fname for d in self.dirs.get(path, [])]
+        rpath = self._resolve(path, listing=True)
+        if self.unpacking:
+            self._wait_unpack(rpath, listing=True)
+        return [d.fname for d in self.dirs.get(rpath, [])]
 
     def _add_file(self, fn, entry):
         """Adds a file and make sure it's seen in the parent/directory."""
@@ -380,6 +867,37 @@ class Context(LoggingMixIn, Operations):
             cont = {'_time': entry.time}
             ne = DirEntry(dpath, cont)
             self._add_file(dpath, ne)
+        elif mounted:
+            # The directory changed after the filesystem was mounted (typically a new .unp directory).
+            self.touch_dir(dpath)
+
+    def touch_dir(self, path):
+        """Bumps the ctime of a directory that changed after mounting, so tools looking at ctime can see it.
+        This does not invalidate anything in the kernel: fusepy (libfuse2 high-level API) has no way of
+        doing that. The kernel keeps cached attributes and lookups until attr_timeout/entry_timeout expire,
+        so the timeouts are the only way to control how long stale entries can be seen.
+        """
+        if isinstance(entry := self.files.get(path, None), DirEntry):
+            entry.ctime = max(entry.ctime, time())
+
+    def add_view(self, view):
+        """Adds the root directory of a view. The rest of the view is populated on first use."""
+        self.views[view.root] = view
+        self.add_entry(DirEntry(view.root, {'_time': time()}))
+
+    def add_alias(self, path, target):
+        """Makes 'path' show the contents of 'target' (a directory in the main tree)."""
+        if path in self.files:
+            print(f"WARNING: {path} already exists, not adding alias for {target}")
+            return
+        self.aliases[path] = target
+        self.add_entry(AliasEntry(path, self.files[target]))
+
+    def remove_entry(self, path):
+        """Removes a file or an empty directory."""
+        if (entry := self.files.pop(path, None)) is not None:
+            self.dirs[entry.parent].remove(entry)
+            self.touch_dir(entry.parent)
 
     def add_entry(self, entry):
         """Add entry to file/pathnames and directories.
@@ -391,28 +909,142 @@ class Context(LoggingMixIn, Operations):
             logging.log(logging.DEBUG, f"add_entry zip file/dir entry for path {entry.pathname} in dir {entry.parent}")
 
 
-def make_sub_path(a_path, sub):
+class SubmissionIndex:
+    """Layouts of the views, computed from the rows of the submission index (see submission_index.py).
+    Paths in the main tree are found with make_sub_path, like in mount_course.
+    The rows are built when the first view is materialized, so mounting without views does not pay for them.
+    """
+    def __init__(self, assignments, c_path=''):
+        self.assignments = assignments
+        self.c_path = c_path
+        self._rows = None
+        self.lock = threading.Lock()
+
+    @property
+    def rows(self):
+        with self.lock:
+            if self._rows is None:
+                self._rows = build_index(self.assignments)
+            return self._rows
+
+    def _sub_path(self, r):
+        return make_sub_path(f"{self.c_path}/{r['assignment']}", r)
+
+    def _subs(self):
+        """One row for each submission"""
+        return list({(r['assignment'], r['student']) : r for r in reversed(self.rows)}.values())[::-1]
+
+    # Layouts: each returns (path parts below the view root, path in the main tree) for the shared directories.
+    def by_student(self):
+        return [([r['student'], r['assignment']], self._sub_path(r)) for r in self._subs()]
+
+    def by_grade(self):
+        return [([r['assignment'], str(r['entered_grade']), r['student']], self._sub_path(r)) for r in self._subs()]
+
+    def by_group(self):
+        return [([r['assignment'], r['group'] or "_no_group", r['student']], self._sub_path(r)) for r in self._subs()]
+
+    def ungraded(self):
+        return [([r['assignment'], r['student']], self._sub_path(r)) for r in self._subs() if r['ungraded']]
+
+    def latest(self, n):
+        """The n most recent attempts, named '<submitted_at> <assignment> - <student>' so they list in time order."""
+        attempts = {(r['assignment'], r['student'], r['attempt']) : r for r in self.rows
+                    if r['attempt'] is not None and r['submitted_at'] is not None}
+        rows = sorted(attempts.values(), key=lambda r: r['submitted_at'], reverse=True)[:n]
+        return [([f"{r['submitted_at']} {r['assignment']} - {r['student']}"], f"{self._sub_path(r)}/{r['attempt']}")
+                for r in rows]
+
+
+class View:
+    """A virtual root directory (like /by-grade) showing the submissions with a different layout.
+    The directories are created from the SubmissionIndex when the view is first used, and the
+    submission/attempt directories are shared with the main tree instead of being copied.
+    """
+    def __init__(self, root, layout):
+        self.root = root
+        self.layout = layout
+        self.materialized = False
+        self.lock = threading.Lock()
+
+    def materialize(self, ctx):
+        if self.materialized:
+            return
+        with self.lock:
+            if self.materialized:
+                return
+            for parts, target in self.layout():
+                ctx.add_alias("/".join([self.root] + parts), target)
+            self.materialized = True
+
+    # view name -> name of the SubmissionIndex layout method
+    LAYOUTS = {
+        'by-student' : 'by_student',
+        'by-grade' : 'by_grade',
+        'by-group' : 'by_group',
+        'ungraded-since-last-attempt' : 'ungraded',
+    }
+
+    @classmethod
+    def parse_names(cls, names):
+        """Parses a comma separated list of view names ('all' gives all of them).
+        'latest-N' shows the N most recent attempts, 'latest' the DEFAULT_LATEST most recent ones.
+        Returns a list of view names, with N filled in for the latest views. Raises ValueError for unknown names.
+        """
+        names = [n.strip() for n in names.split(',') if n.strip() != '']
+        if 'all' in names:
+            names = list(cls.LAYOUTS) + ['latest']
+        parsed = []
+        for name in names:
+            if name == 'latest':
+                name = f'latest-{DEFAULT_LATEST}'
+            if name.startswith('latest-'):
+                n = name[len('latest-'):]
+                if not n.isdigit() or int(n) == 0:
+                    raise ValueError(f"Unknown view {name}: N in latest-N must be a positive number")
+                name = f'latest-{int(n)}'
+            elif name not in cls.LAYOUTS:
+                raise ValueError(f"Unknown view {name}. Use one of {', '.join(list(cls.LAYOUTS) + ['latest-N', 'all'])}")
+            parsed.append(name)
+        return parsed
+
+    @classmethod
+    def from_names(cls, names, index, c_path=''):
+        """Creates views from a comma separated list of view names (see parse_names).
+        c_path : path of the course directory the views are added to.
+        """
+        views = []
+        for name in cls.parse_names(names):
+            if name in cls.LAYOUTS:
+                views.append(cls(f'{c_path}/{name}', getattr(index, cls.LAYOUTS[name])))
+            else:
+                n = int(name[len('latest-'):])
+                views.append(cls(f'{c_path}/{name}', functools.partial(index.latest, n)))
+        return views
+
+
+def make_sub_path(a_path, srow):
     """Make submissionm path prefix as "assignment_name"/<..>/student_name".
+    srow : the submission part of a submission index row (at least the fields from submission_index.submission_info).
     Optionally injects (in the following path order):
     - submission status (submitted or not)
     - grade status
     - group name 
     """
-    sname = sub['student_name']
-    group = sub.get("group", None)
+    sname = srow['student']
+    gname = srow['group']
     parts = [a_path, sname]
 
-    if by_group and group is not None and group['name'] is not None:
-        gname = group['name']
+    if by_group and gname is not None:
         parts.insert(1, gname)
 
     if by_grade:
         # TODO: consider setting ungraded as something else than None
-        grade = str(sub['entered_grade'])
+        grade = str(srow['entered_grade'])
         parts.insert(1, grade)
         
     if by_submitted:
-        if sub['workflow_state'] == 'unsubmitted':
+        if srow['workflow_state'] == 'unsubmitted':
             parts.insert(1, "unsubmitted")
         else:
             parts.insert(1, "submitted")
@@ -421,27 +1053,41 @@ def make_sub_path(a_path, sub):
     return sub_path    
             
 
-def mount_fs():
-    # Make sure the cache directory exists
-    os.makedirs(CACHE_DIR, exist_ok=True)
-
-    ctx = Context()
-
-    # The json file contains a list of assignments.
-    assignments = json.loads(open(f"{CACHE_DIR}/assignments.json").read())
+def find_courses():
+    """Returns a list of (course path, metadata snapshot) for the courses to mount.
+    get-submission-info.py stores one snapshot per course in CACHE_DIR/courses/<name>/ when config.toml
+    lists several courses. These are mounted as /<name>/. A single course snapshot in CACHE_DIR is mounted at the root.
+    Raises ValueError if --courses names a course that has not been fetched.
+    """
+    cdir = f"{CACHE_DIR}/courses"
+    if not os.path.isdir(cdir):
+        if args.courses:
+            raise ValueError(f"--courses: no courses in {cdir}. Fetch them with get-submission-info.py")
+        return [('', f"{CACHE_DIR}/assignments.json")]
+    fetched = sorted(name for name in os.listdir(cdir) if os.path.exists(f"{cdir}/{name}/assignments.json"))
+    names = fetched
+    if args.courses:
+        names = [n.strip() for n in args.courses.split(',') if n.strip() != '']
+        if (unknown := [n for n in names if n not in fetched]):
+            raise ValueError(f"Unknown course(s) {', '.join(unknown)}. Fetched courses: {', '.join(fetched)}")
+    return [(f"/{name}", f"{cdir}/{name}/assignments.json") for name in names]
+
+
+def mount_course(ctx, c_path, assignments):
+    """Adds the assignments of a course below c_path ('' for the root) and returns the SubmissionIndex for the course."""
 
     # For each level in the hiearchy, a .meta file is added with json encoded metadata for that level in the directory.
     # The information is filtered to avoid replicating everything from a further in at the root level.
     for a in assignments:
         # Top level directory for each assignment.
-        a_path = '/' + a['name']
+        a_path = f"{c_path}/{a['name']}"
         ctx.add_entry(DirEntry(a_path, a, time_entry='created_at'))
         ctx.add_entry(MetaEntry(a_path, a, time_entry='updated_at', filter_entries={'f_studs', 'f_submissions'}))
         # logging.log(logging.DEBUG, f"{dirs}")
         for sub in a['f_submissions']:
             # Each submission is in a subdirectory with the name of the student.
             # sub_path = f"{a_path}/{sub['student_name']}"
-            sub_path = make_sub_path(a_path, sub)
+            sub_path = make_sub_path(a_path, submission_info(a, sub))
             # Students that haven't submitted still show up, but submitted_at is non-existing. This gives us a 0 epoch time.
             ctx.add_entry(DirEntry(sub_path, sub, time_entry='submitted_at'))
             ctx.add_entry(MetaEntry(sub_path, sub, time_entry='submitted_at', filter_entries={'submission_history'}))
@@ -456,13 +1102,30 @@ def mount_fs():
                 for att in s.get('attachments', []):
                     # Each file in the submission
                     fpath = f"{attempt_path}/{att['filename']}"
-                    if ZipEntry.possible_archive(fpath):
+                    if ZipEntry.possible_archive(att['id'], fpath):
                         # Note: the 'unp' directory is not added until the zip file is downloaded (by reading it)
                         # The reason for this is to avoid triggering downloads of all zip files using "find", file managers etc.
                         # TODO: option to turn this mount time unpacking off.
                         ctx.add_entry(ZipEntry(fpath, att, ctx, time_entry='modified_at'))
                     else:
                         ctx.add_entry(Entry(fpath, att, time_entry='modified_at'))
+    return SubmissionIndex(assignments, c_path)
+
+
+def mount_fs():
+    # Make sure the cache directory exists
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    downloader.scan()
+
+    ctx = Context(kernel_cache=args.kernel_cache)
+
+    # All courses share the Context, the downloader (and cache budget) and the dedup cache (ddmcache).
+    for c_path, snapshot in find_courses():
+        # The json file contains a list of assignments.
+        assignments = json.loads(open(snapshot).read())
+        index = mount_course(ctx, c_path, assignments)
+        for view in View.from_names(args.views, index, c_path):
+            ctx.add_view(view)
 
     ctx.add_entry(DebugEntry())
     global auto_unpack
@@ -470,11 +1133,31 @@ def mount_fs():
     print("dedup cache info: ", ddmcache.cache_info())
     print("Ready")
 
-    FUSE(ctx, args.mount, foreground=True, ro=True, allow_other=True)
+    fuse_opts = {}
+    if args.kernel_cache:
+        # Stable inode numbers + longer attr/entry timeouts let the kernel answer repeated lookups,
+        # stats and reads (with keep_cache set in open) without calling back into Python.
+        timeout = KERNEL_CACHE_TIMEOUT
+        fuse_opts = dict(raw_fi=True, use_ino=True, negative_timeout=0,
+                         attr_timeout=timeout if args.attr_timeout is None else args.attr_timeout,
+                         entry_timeout=timeout if args.entry_timeout is None else args.entry_timeout)
+    else:
+        if args.attr_timeout is not None:
+            fuse_opts['attr_timeout'] = args.attr_timeout
+        if args.entry_timeout is not None:
+            fuse_opts['entry_timeout'] = args.entry_timeout
+
+    global mounted
+    mounted = True
+    FUSE(ctx, args.mount, foreground=True, ro=True, allow_other=True, **fuse_opts)
 
 
 
 auto_unpack = False
+# Set when the tree is built and the filesystem is about to be mounted.
+mounted = False
+# Archives inside archives are unpacked down to this nesting level.
+max_nesting = 3
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -483,10 +1166,29 @@ if __name__ == '__main__':
     parser.add_argument('-bgrade', '--by_grade', action="store_true", help="Organize by entered grade") 
     parser.add_argument('-bg', '--by_group', action="store_true", help="Organize by submission group") 
     parser.add_argument('-nu', '--noautounpack', action="store_true", help="Do not unpack archives automatically on boot") 
+    parser.add_argument('-kc', '--kernel_cache', action="store_true",
+                        help="Let the kernel cache attributes, lookups and file contents (stable inodes, keep_cache)")
+    parser.add_argument('--attr_timeout', type=float, help="Seconds the kernel may cache file attributes")
+    parser.add_argument('--entry_timeout', type=float, help="Seconds the kernel may cache name lookups")
+    parser.add_argument('-V', '--views', default="",
+                        help="Comma separated list of extra layouts added as root directories: "
+                        "by-student, by-grade, by-group, ungraded-since-last-attempt, latest-N or all")
+    parser.add_argument('--courses', help="Comma separated list of courses to mount (default: all fetched courses)")
+    parser.add_argument('--cache_limit', type=float, help="Max size (MB) of downloaded files kept in the cache")
+    parser.add_argument('--max_nesting', type=int, default=max_nesting,
+                        help="Unpack archives inside archives down to this level (0: only submitted archives)")
+    parser.add_argument('--unpack_workers', type=int, help="Number of processes used for unpacking archives")
     parser.add_argument('mount')
     args = parser.parse_args()
+    if args.unpack_workers is not None and args.unpack_workers < 1:
+        parser.error("--unpack_workers must be at least 1")
+    try:
+        View.parse_names(args.views)
+    except ValueError as e:
+        parser.error(str(e))
 
     auto_unpack = not args.noautounpack
+    max_nesting = args.max_nesting
     by_group = args.by_group
     by_submitted = args.by_submitted
     by_grade = args.by_grade
@@ -495,5 +1197,12 @@ if __name__ == '__main__':
 
     if args.cache:
         CACHE_DIR = args.cache
+    unpack_pool.workers = args.unpack_workers
+    if args.cache_limit is not None:
+        downloader.budget = int(args.cache_limit * 2**20)
+    try:
+        find_courses()
+    except ValueError as e:
+        parser.error(str(e))
 
     mount_fs()
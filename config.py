@@ -3,12 +3,20 @@
 """Work-in progress to move config settings to a config file (toml).
 """
 
+import sys
 import tomllib
 
 config = tomllib.loads(open("config.toml", 'r', encoding="utf-8").read())
 
 BASE_URL  = config['base_url']
-COURSE_ID = config['course_id']
+
+# Either a single course (course_id) or several courses in a [courses] table (name = course_id).
+# Each course in [courses] is mounted as a subdirectory with that name.
+# COURSE_ID is None when only [courses] is given, so scripts handling one course must pick one from COURSES.
+COURSES = config.get('courses', {})
+COURSE_ID = config.get('course_id', None)
+if COURSE_ID is None and len(COURSES) == 0:
+    sys.exit("config.toml: set either course_id or a [courses] table with name = course_id entries")
 
 # To view submissions after a course is closed, or to view students that have withdrawn from the course.
 INCLUDE_COMPLETED = config.get('include_completed', True)
@@ -2,6 +2,7 @@
 
 """
 Fetch and print group information.
+With several courses in config.toml ([courses]), the course is selected with --course <name>.
 """
 
 import canvasapi
@@ -11,11 +12,16 @@ import argparse
 import datetime
 from collections import Counter
 import tomllib
-from config import BASE_URL, COURSE_ID, INCLUDE_COMPLETED, api_key
+from config import BASE_URL, COURSE_ID, COURSES, INCLUDE_COMPLETED, api_key
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--course', choices=list(COURSES), required=COURSE_ID is None,
+                    help="Name of the course in [courses] (default: course_id)")
+args = parser.parse_args()
+course_id = COURSES[args.course] if args.course is not None else COURSE_ID
 
 canvas = canvasapi.Canvas(BASE_URL, api_key)
-course = canvas.get_course(COURSE_ID)
+course = canvas.get_course(course_id)
 
 print("Fetching groups")
 groups = list(course.get_groups())
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """
 Downloads information about assignments from the provided course (COURSE_ID).
-The information is stored in a json file as data/assignments.json.
+The information is stored in a json file as .cache/assignments.json, along with a flat
+index of the submissions in .cache/submission_index.json (see submission_index.py).
+
+If several courses are listed in config.toml (COURSES), each course is stored as .cache/courses/<name>/assignments.json.
 """
 
 import canvasapi
@@ -9,7 +12,8 @@ import json
 import os
 import argparse
 import datetime
-from config import BASE_URL, COURSE_ID, INCLUDE_COMPLETED, api_key
+from config import BASE_URL, COURSE_ID, COURSES, INCLUDE_COMPLETED, api_key
+from submission_index import store_index
 
 
 
@@ -72,64 +76,69 @@ def store_data(fname, data):
     
 canvas = canvasapi.Canvas(BASE_URL, api_key)
 
-# https://canvasapi.readthedocs.io/en/stable/course-ref.html
-course = canvas.get_course(COURSE_ID)
-
-
 parser = argparse.ArgumentParser()
 parser.add_argument("-b", action="store_true", help="Store a backup file with the date in the name")
 args = parser.parse_args()
 
-# Make sure the cache directory exists
-os.makedirs(".cache", exist_ok=True)
-
-# https://canvasapi.readthedocs.io/en/stable/assignment-ref.html
-print("Fetching assignments and students")
-assignments = list(course.get_assignments())
-assignments.sort(key=lambda x: x.name)
-
-# Active students. {id: canvasapi.user.User, ...}
-students = {s.id : s for s in course.get_users(include=['enrollments']) if has_student_enrollment(s.enrollments)}
-print(f"  - {len(students)} active students")
-# Students that have withddrawn or are marked as concluded/completed/prior, which happens
-# to almost all students when the semester is over.
-students_compl = {s.id : s for s in course.get_users(enrollment_state=['completed'], include=['enrollments'])
-                  if is_completed_student(s)}
-print(f"  - {len(students_compl)} completed students sorted by name")
-for sid, s in sorted(students_compl.items(), key=lambda kv: kv[1].name):
-    print("      - ", s)
-
-alist = []
-for a in assignments:
-    print('Fetching info for', a.name)
-    subs = list(a.get_submissions(include=['submission_history', 'submission_comments', 'group']))
-    print(' -- got submissions')
-    # NB: this list of students [canvasapi.user.UserDisplay, ...] does not
-    # have the same information as students and students_compl
-    studs = list(a.get_gradeable_students())
-    print(' -- got students')
-
-    if INCLUDE_COMPLETED:
-        studs.extend(students_compl.values())
-        print(" -- adding submissions from completed students")
-        subs += get_compl_submissions(a)
-
-    f_studs = {int(s.id) : stud_to_dict(s) for s in studs}
-    ad = {
-        'created_at' : a.created_at,
-        'updated_at' : a.updated_at,
-        'name'  : a.name,
-        'f_studs' : f_studs,
-        'f_submissions' : [subm_to_dict(s, f_studs) for s in subs],
-    }
-    alist.append(ad)
-
-
-store_data('.cache/assignments.json', alist)
-
-if args.b:
-    tnow = datetime.datetime.now().strftime("%Y-%m-%d--%H%M")
-    bfname = f'.cache/assignments-{tnow}.json'
-    print("Storing backup as", bfname)
-    store_data(bfname, alist)
-    
+# Without a [courses] table, the single course is stored directly in .cache
+courses = COURSES.items() if COURSES else [(None, COURSE_ID)]
+for cname, course_id in courses:
+    cdir = ".cache" if cname is None else f".cache/courses/{cname}"
+    if cname is not None:
+        print(f"======== Course {cname} ({course_id}) ========")
+    # Make sure the cache directory exists
+    os.makedirs(cdir, exist_ok=True)
+
+    # https://canvasapi.readthedocs.io/en/stable/course-ref.html
+    course = canvas.get_course(course_id)
+
+    # https://canvasapi.readthedocs.io/en/stable/assignment-ref.html
+    print("Fetching assignments and students")
+    assignments = list(course.get_assignments())
+    assignments.sort(key=lambda x: x.name)
+
+    # Active students. {id: canvasapi.user.User, ...}
+    students = {s.id : s for s in course.get_users(include=['enrollments']) if has_student_enrollment(s.enrollments)}
+    print(f"  - {len(students)} active students")
+    # Students that have withddrawn or are marked as concluded/completed/prior, which happens
+    # to almost all students when the semester is over.
+    students_compl = {s.id : s for s in course.get_users(enrollment_state=['completed'], include=['enrollments'])
+                      if is_completed_student(s)}
+    print(f"  - {len(students_compl)} completed students sorted by name")
+    for sid, s in sorted(students_compl.items(), key=lambda kv: kv[1].name):
+        print("      - ", s)
+
+    alist = []
+    for a in assignments:
+        print('Fetching info for', a.name)
+        subs = list(a.get_submissions(include=['submission_history', 'submission_comments', 'group']))
+        print(' -- got submissions')
+        # NB: this list of students [canvasapi.user.UserDisplay, ...] does not
+        # have the same information as students and students_compl
+        studs = list(a.get_gradeable_students())
+        print(' -- got students')
+
+        if INCLUDE_COMPLETED:
+            studs.extend(students_compl.values())
+            print(" -- adding submissions from completed students")
+            subs += get_compl_submissions(a)
+
+        f_studs = {int(s.id) : stud_to_dict(s) for s in studs}
+        ad = {
+            'created_at' : a.created_at,
+            'updated_at' : a.updated_at,
+            'name'  : a.name,
+            'f_studs' : f_studs,
+            'f_submissions' : [subm_to_dict(s, f_studs) for s in subs],
+        }
+        alist.append(ad)
+
+    store_data(f'{cdir}/assignments.json', alist)
+    # Flat index used by list-assignments.py
+    store_index(cdir, alist)
+
+    if args.b:
+        tnow = datetime.datetime.now().strftime("%Y-%m-%d--%H%M")
+        bfname = f'{cdir}/assignments-{tnow}.json'
+        print("Storing backup as", bfname)
+        store_data(bfname, alist)
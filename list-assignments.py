@@ -2,124 +2,116 @@
 """
 Displays some selected information from the canvas assignments.
 Mainly used for exploring/debugging.
+
+Uses the flat submission index (see submission_index.py) with one row per attachment in each attempt.
+Rows can be filtered and sorted, and printed as a report (default), json or csv.
+
+Example: submissions to assignment 2 with a similarity score of 30 or more, newest first, as csv:
+
+    python3 list-assignments.py -a "Assignment 2" --min_score 30 --sort=-latest --format csv
 """
 
 import json
+import csv
+import os
+import sys
 import argparse
-
-CACHE_DIR = ".cache"
+from submission_index import FIELDS, load_index
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--cache', default=".cache")  # cache directory
+parser.add_argument('-a', '--assignment', help="Only assignments with names containing this")
+parser.add_argument('-s', '--student', help="Only students with names containing this")
+parser.add_argument('--state', help="Only submissions with this workflow_state (submitted, graded, unsubmitted ...)")
+parser.add_argument('--grade', help="Only submissions with this entered grade ('None' for ungraded)")
+parser.add_argument('--since', help="Only submissions with attempts at or after this date (YYYY-MM-DD...)")
+parser.add_argument('--min_score', type=float, help="Only submissions with a similarity score at or above this")
+parser.add_argument('--sort', default="assignment,latest,student",
+                    help="Comma separated list of columns to sort by. Prefix a column with '-' for descending order")
+parser.add_argument('-f', '--format', choices=['report', 'json', 'csv'], default='report')
 args = parser.parse_args()
-CACHE_DIR = args.cache
-
-assignments = json.loads(open(f'{CACHE_DIR}/assignments.json').read())
-
-
-def newest_update(subinfo):
-    """Recursively searches subinfo for 'updated_at' or 'submitted_at' and returns the most recent date"""
-    def get_date(d, key):
-        v = d.get(key, '')
-        if v is None:
-            v = ''
-        # if v != '':
-        #    print("GOT ", key, v)
-        return v
-
-    def get_seq(sub):
-        if isinstance(sub, list):
-            return sub
-        if isinstance(sub, dict):
-            return sub.values()
-        return []
-    cur = ''
-    if isinstance(subinfo, dict):
-        # cur = max('', get_date(subinfo, 'submitted_at'), get_date(subinfo, 'updated_at'))
-        cur = max('', get_date(subinfo, 'submitted_at'))
-    for c in get_seq(subinfo):
-        cur = max(cur, newest_update(c))
-
-    return cur
-
-
-def sort_str(sub):
-    """latest submission date + student name"""
-    name = sub.get('student_name', '0zzzzz')
-    tm = newest_update(sub)
-    if tm == '':
-        tm = '0'
-    # print(name, tm)
-    return tm + name
-
-
-def get_similarities(sub):
-    # each submission has a 'submission_history' list of sub-submissions.
-    # each sub-submission has a 'turnitin_data' with 'attachment_x' as keys,
-    # and 'attachment_id' : x as id for the attachment, and 'similiarity_score' : (null or some float)
-    # as a score. Need to flatten this to a dict of 'id/x' : score
-    scores = {}
-    # print('SUB', sub)
-    for subsub in sub['submission_history']:
-        # print('SUBSUB', subsub)
-        for td in subsub.get('turnitin_data', {}).values():
-            if not isinstance(td, dict):
-                # some might have extra info here. Skip that.
-                continue
-            # print('......', td)
-            if 'attachment_id' not in td:
-                # have seen some with a single dict: td = {'status': 'pending'}
-                continue
-            scores[td['attachment_id']] = td.get('similarity_score', 'UNKNOWN')
-    return scores
-
-
-def attr(att, key):
-    return f"{key}={att.get(key, '_NA_')}"
-
-
-total_files = 0
-for a in assignments:
-    print(f"---------------------\n{a['name']}---------------\n")
-    # Probably the only useful info about the user here is the name.
-    # studs = a['f_studs']
-    subs = a['f_submissions']
-    for sub in sorted(subs, key=sort_str):
-        # sub.keys: ['assignment_id', 'attempt', 'body',
-        # 'cached_due_date', 'course_id', 'display_name',
-        # 'entered_grade', 'entered_score', 'excused',
-        # 'extra_attempts', 'grade',
-        # 'grade_matches_current_submission', 'graded_at',
-        # 'grader_id', 'grading_period_id', 'id', 'late',
-        # 'late_policy_status', 'missing', 'points_deducted',
-        # 'posted_at', 'preview_url', 'score', 'seconds_late',
-        # 'submission_comments', 'submission_history',
-        # 'submission_type', 'submitted_at', 'url', 'user_id',
-        # 'workflow_state']
-        # also: added student_name in the get-submission-info file
-        turnitin_scores = get_similarities(sub)
-        max_score = max([0] + [v for v in turnitin_scores.values() if type(v) == float])
-        print(sub['student_name'], newest_update(sub), sub['excused'], sub['attempt'], sub['workflow_state'], sub['grade'], sub['entered_grade'], f"{max_score=}")
-        # print(sub['student_name'])# , sub['excused'], sub['attempt'], sub['workflow_state'], sub['grade'], sub['entered_grade'])
-        for s in sub['submission_history']:
-            print("      ", s['attempt'], s["submitted_at"], s['cached_due_date'])
-            for att in s.get('attachments', []):
-                sid = att.get('id', None)
-                if sid not in turnitin_scores:
-                    print(f"             NOT IN turnitin_scores: {sid}")
-                    continue
-                score = turnitin_scores[sid]
-                # url includes authentication, so can download it easily
-                # att.keys: ['content-type', 'created_at', 'display_name',
-                # 'filename', 'folder_id', 'hidden',
-                # 'hidden_for_user', 'id', 'lock_at', 'locked',
-                # 'locked_for_user', 'media_entry_id', 'mime_class',
-                # 'modified_at', 'preview_url', 'size',
-                # 'thumbnail_url', 'unlock_at', 'updated_at',
-                # 'upload_status', 'url', 'uuid']
-                print("             ", attr(att, 'filename'), attr(att, 'updated_at'), attr(att, 'size'),
-                      f"{score=}", attr(att, 'url'))
-                total_files += 1
+
+
+def matches(row):
+    return ((args.assignment is None or args.assignment in row['assignment']) and
+            (args.student is None or args.student in row['student']) and
+            (args.state is None or args.state == row['workflow_state']) and
+            (args.grade is None or args.grade == str(row['entered_grade'])) and
+            (args.since is None or row['latest'] >= args.since) and
+            (args.min_score is None or row['max_score'] >= args.min_score))
+
+
+def sort_rows(rows, columns):
+    """Sorts on each column, starting with the least significant one.
+    The sorts are stable, so attempts and files within a submission stay in the order they were handed in.
+    """
+    for col in reversed(columns.split(',')):
+        desc = col.startswith('-')
+        col = col.lstrip('-')
+        if col not in FIELDS:
+            sys.exit(f"Unknown column {col}. Use one of {', '.join(FIELDS)}")
+        # Columns can mix numbers and strings (like 'UNKNOWN' scores).
+        rows.sort(key=lambda r: (isinstance(r[col], str), r[col] if r[col] is not None else 0), reverse=desc)
+        # None sorts last in both directions (a separate, stable pass that is never reversed).
+        rows.sort(key=lambda r: r[col] is None)
+    return rows
+
+
+def attr(row, key):
+    return f"{key}={'_NA_' if row[key] is None else row[key]}"
+
+
+def print_report(rows):
+    """Rows are grouped by assignment and submission when consecutive rows share them."""
+    total_files = 0
+    cur_a = cur_sub = cur_attempt = None
+    for row in rows:
+        if row['assignment'] != cur_a or row['student'] != cur_sub:
+            if cur_sub is not None:
+                print()
+        if row['assignment'] != cur_a:
+            cur_a = row['assignment']
+            cur_sub = cur_attempt = None
+            print(f"---------------------\n{cur_a}---------------\n")
+        if row['student'] != cur_sub:
+            cur_sub = row['student']
+            cur_attempt = None
+            max_score = row['max_score']
+            print(row['student'], row['latest'], row['excused'], row['attempts'], row['workflow_state'],
+                  row['grade'], row['entered_grade'], f"{max_score=}")
+        if row['attempt'] is None:
+            continue
+        if row['attempt'] != cur_attempt:
+            cur_attempt = row['attempt']
+            print("      ", row['attempt'], row['submitted_at'], row['cached_due_date'])
+        if row['attachment_id'] is None:
+            continue
+        if not row['turnitin']:
+            print(f"             NOT IN turnitin_scores: {row['attachment_id']}")
+            continue
+        score = row['score']
+        # url includes authentication, so can download it easily
+        print("             ", attr(row, 'filename'), attr(row, 'updated_at'), attr(row, 'size'),
+              f"{score=}", attr(row, 'url'))
+        total_files += 1
+    if cur_sub is not None:
         print()
-# print(sorted(list(att.keys())))
-print("Total number of files", total_files)
+    print("Total number of files", total_files)
+
+
+if not os.path.exists(f"{args.cache}/assignments.json"):
+    cdir = f"{args.cache}/courses"
+    if os.path.isdir(cdir):
+        sys.exit(f"No assignments.json in {args.cache}. With several courses, use -c {cdir}/<name> "
+                 f"(one of {', '.join(sorted(os.listdir(cdir)))})")
+    sys.exit(f"No assignments.json in {args.cache}. Fetch it with get-submission-info.py")
+
+rows = sort_rows([r for r in load_index(args.cache) if matches(r)], args.sort)
+if args.format == 'json':
+    print(json.dumps(rows, indent=4))
+elif args.format == 'csv':
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+else:
+    print_report(rows)
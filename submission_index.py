@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Flat index of the submissions in assignments.json.
+
+Each row is one attachment of one attempt of a submission, with the submission info repeated on each row.
+Attempts without attachments and submissions without attempts get a single row with the missing fields set to None.
+The index is written by get-submission-info.py as submission_index.json next to assignments.json,
+and is used by list-assignments.py to avoid walking the full assignments.json. canvasfs.py builds the
+views (like /by-grade) from the same rows.
+"""
+
+import json
+import os
+
+INDEX_FILE = "submission_index.json"
+
+# Columns in the index (and the order used for csv output).
+FIELDS = [
+    'assignment', 'student', 'group', 'workflow_state', 'excused', 'grade', 'entered_grade', 'attempts',
+    'latest', 'ungraded', 'max_score',
+    'attempt', 'submitted_at', 'cached_due_date',
+    'attachment_id', 'filename', 'updated_at', 'size', 'score', 'turnitin', 'url',
+]
+
+
+def get_similarities(sub):
+    """Returns a dict with attachment id : similarity score for all attempts of the submission."""
+    # each submission has a 'submission_history' list of sub-submissions.
+    # each sub-submission has a 'turnitin_data' with 'attachment_x' as keys,
+    # and 'attachment_id' : x as id for the attachment, and 'similiarity_score' : (null or some float)
+    # as a score. Need to flatten this to a dict of 'id/x' : score
+    scores = {}
+    for subsub in sub['submission_history']:
+        for td in (subsub.get('turnitin_data', None) or {}).values():
+            if not isinstance(td, dict):
+                # some might have extra info here. Skip that.
+                continue
+            if 'attachment_id' not in td:
+                # have seen some with a single dict: td = {'status': 'pending'}
+                continue
+            scores[td['attachment_id']] = td.get('similarity_score', 'UNKNOWN')
+    return scores
+
+
+def newest_update(sub):
+    """Most recent 'submitted_at' of the submission and its attempts ('' if nothing is submitted)"""
+    dates = [sub.get('submitted_at', None)] + [s.get('submitted_at', None) for s in sub['submission_history']]
+    return max([''] + [d for d in dates if d is not None])
+
+
+def is_ungraded(sub):
+    """True if the latest attempt was submitted after the submission was last graded (or was never graded)."""
+    hist = [s for s in sub['submission_history'] if s.get('attempt', None) is not None]
+    if sub.get('excused', None) or len(hist) == 0:
+        return False
+    last = max(hist, key=lambda s: s['attempt'])
+    if (submitted := last.get('submitted_at', None)) is None:
+        return False
+    graded = last.get('graded_at', None)
+    return last.get('workflow_state', None) == 'submitted' or graded is None or graded < submitted
+
+
+def submission_info(a, sub):
+    """The fields of submission_row that are copied straight from the submission (no need to walk the attempts)."""
+    group = sub.get('group', None)
+    return {
+        'assignment' : a['name'],
+        'student' : sub['student_name'],
+        'group' : group['name'] if group is not None else None,
+        'workflow_state' : sub['workflow_state'],
+        'excused' : sub['excused'],
+        'grade' : sub['grade'],
+        'entered_grade' : sub['entered_grade'],
+        'attempts' : sub['attempt'],
+    }
+
+
+def submission_row(a, sub, scores=None):
+    """The submission part of the index rows for submission sub in assignment a."""
+    if scores is None:
+        scores = get_similarities(sub)
+    return dict(submission_info(a, sub),
+                latest=newest_update(sub),
+                ungraded=is_ungraded(sub),
+                max_score=max([0] + [v for v in scores.values() if type(v) == float]))
+
+
+def build_index(assignments):
+    """Returns the index rows for a list of assignments (the contents of assignments.json)."""
+    rows = []
+    for a in assignments:
+        for sub in a['f_submissions']:
+            scores = get_similarities(sub)
+            srow = submission_row(a, sub, scores)
+            attempt_rows = []
+            for s in sub['submission_history']:
+                if s.get('attempt', None) is None:
+                    continue
+                arow = dict(srow, attempt=s['attempt'], submitted_at=s.get('submitted_at', None),
+                            cached_due_date=s.get('cached_due_date', None))
+                atts = s.get('attachments', [])
+                attempt_rows.extend(dict(arow,
+                                         attachment_id=att.get('id', None),
+                                         filename=att.get('filename', None),
+                                         updated_at=att.get('updated_at', None),
+                                         size=att.get('size', None),
+                                         score=scores.get(att.get('id', None), None),
+                                         turnitin=att.get('id', None) in scores,
+                                         url=att.get('url', None)) for att in atts)
+                if len(atts) == 0:
+                    attempt_rows.append(arow)
+            rows.extend(attempt_rows if len(attempt_rows) > 0 else [srow])
+    return [{f : r.get(f, None) for f in FIELDS} for r in rows]
+
+
+def store_index(cache_dir, assignments):
+    with open(f"{cache_dir}/{INDEX_FILE}", 'w') as f:
+        f.write(json.dumps(build_index(assignments)))
+
+
+def load_index(cache_dir):
+    """Loads the index from cache_dir. The index is rebuilt (and stored) if it is missing,
+    older than assignments.json or has other columns than FIELDS.
+    """
+    ipath = f"{cache_dir}/{INDEX_FILE}"
+    apath = f"{cache_dir}/assignments.json"
+    if os.path.exists(ipath) and os.path.getmtime(ipath) >= os.path.getmtime(apath):
+        rows = json.loads(open(ipath).read())
+        if len(rows) == 0 or list(rows[0]) == FIELDS:
+            return rows
+    store_index(cache_dir, json.loads(open(apath).read()))
+    return json.loads(open(ipath).read())